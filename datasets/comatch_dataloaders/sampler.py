@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 
 
@@ -166,6 +167,33 @@ class WeightedRandomSampler(Sampler):
         return self.num_samples
 
 
+class FastBatchSampler(Sampler):
+    r"""Yields batches of with-replacement indices, drawing the whole epoch
+    in a single np.random.randint call instead of one Python RNG call per
+    sample (as RandomSampler + BatchSampler do).
+
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        batch_size (int): size of each yielded batch
+        num_batches (int): number of batches per epoch
+    """
+
+    def __init__(self, data_source, batch_size, num_batches):
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        indices = np.random.randint(0, len(self.data_source),
+                                    size=self.num_batches * self.batch_size,
+                                    dtype=np.int64)
+        for row in indices.reshape(self.num_batches, self.batch_size):
+            yield row.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+
 class BatchSampler(Sampler):
     r"""Wraps another sampler to yield a mini-batch of indices.
 
@@ -2,6 +2,40 @@ import numpy as np
 import torch
 import cv2
 
+try:
+    from numba import njit
+    _has_numba = True
+except ImportError:
+    _has_numba = False
+
+
+if _has_numba:
+    @njit(cache=True, fastmath=True)
+    def _pad_crop_flip(im, border, sh, sw, h, w, flip):
+        """
+        Reflect-pad by `border`, crop (h, w) at padded offset (sh, sw) and
+        optionally flip horizontally, all in one compiled pass. Matches
+        np.pad(mode='reflect') index arithmetic.
+        """
+        H, W, C = im.shape
+        out = np.empty((h, w, C), dtype=im.dtype)
+        for i in range(h):
+            si = sh + i - border
+            if si < 0:
+                si = -si
+            elif si >= H:
+                si = 2 * H - 2 - si
+            for j in range(w):
+                sj = sw + j - border
+                if sj < 0:
+                    sj = -sj
+                elif sj >= W:
+                    sj = 2 * W - 2 - sj
+                oj = w - 1 - j if flip else j
+                for c in range(C):
+                    out[i, oj, c] = im[si, sj, c]
+        return out
+
 
 class PadandRandomCrop(object):
     """
@@ -32,6 +66,33 @@ class RandomHorizontalFlip(object):
         return im
 
 
+class PadCropFlip(object):
+    """
+    Fused PadandRandomCrop + RandomHorizontalFlip. The random offsets/flip
+    are drawn with cheap numpy calls and the per-pixel work runs in a single
+    numba kernel; without numba it falls back to the two separate ops.
+    """
+
+    def __init__(self, border=4, cropsize=(32, 32), p_flip=0.5):
+        self.border = border
+        self.cropsize = cropsize
+        self.p_flip = p_flip
+        self.fallback = Compose([
+            PadandRandomCrop(border=border, cropsize=cropsize),
+            RandomHorizontalFlip(p=p_flip),
+        ])
+
+    def __call__(self, im):
+        if not _has_numba:
+            return self.fallback(im)
+        H, W = im.shape[0] + 2 * self.border, im.shape[1] + 2 * self.border
+        h, w = self.cropsize
+        dh, dw = max(0, H - h), max(0, W - w)
+        sh, sw = np.random.randint(0, dh), np.random.randint(0, dw)
+        flip = bool(np.random.rand() < self.p_flip)
+        return _pad_crop_flip(np.ascontiguousarray(im), self.border, sh, sw, h, w, flip)
+
+
 class Resize(object):
     def __init__(self, size):
         self.size = size
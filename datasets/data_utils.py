@@ -108,7 +108,8 @@ def get_data_loader(dset,
 
     if data_sampler is None:
         return DataLoader(dset, batch_size=batch_size, shuffle=shuffle,
-                          num_workers=num_workers, pin_memory=pin_memory)
+                          num_workers=num_workers, pin_memory=pin_memory,
+                          persistent_workers=num_workers > 0)
 
     else:
         if isinstance(data_sampler, str):
@@ -141,7 +142,8 @@ def get_data_loader(dset,
 
         batch_sampler = BatchSampler(data_sampler, batch_size, drop_last)
         return DataLoader(dset, batch_sampler=batch_sampler,
-                          num_workers=num_workers, pin_memory=pin_memory)
+                          num_workers=num_workers, pin_memory=pin_memory,
+                          persistent_workers=num_workers > 0)
 
 
 def get_onehot(num_classes, idx):
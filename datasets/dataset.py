@@ -6,7 +6,6 @@ from .augmentation.randaugment import RandAugment
 import torchvision
 from PIL import Image
 import numpy as np
-import copy
 
 
 class BasicDataset(Dataset):
@@ -49,8 +48,8 @@ class BasicDataset(Dataset):
         self.transform = transform
         if self.is_ulb:
             if strong_transform is None:
-                self.strong_transform = copy.deepcopy(transform)
-                self.strong_transform.transforms.insert(0, RandAugment(3, 5))
+                # share the weak ops by reference instead of deep-copying
+                self.strong_transform = transforms.Compose([RandAugment(3, 5)] + list(transform.transforms))
         else:
             self.strong_transform = strong_transform
 
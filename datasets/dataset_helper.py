@@ -72,6 +72,7 @@ def get_dataset_and_loader(args, ulb_workers_multiplier=1, extra_data=False):
                                               data_sampler=args.train_sampler,
                                               num_iters=args.num_train_iter,
                                               num_workers=num_worker_multiplier_lb * args.num_workers,
+                                              pin_memory=True,
                                               distributed=args.distributed)
 
     loader_dict['train_ulb'] = get_data_loader(dset_dict['train_ulb'],
@@ -79,11 +80,13 @@ def get_dataset_and_loader(args, ulb_workers_multiplier=1, extra_data=False):
                                                data_sampler=args.train_sampler,
                                                num_iters=args.num_train_iter,
                                                num_workers=num_worker_multiplier_ulb * args.num_workers,
+                                               pin_memory=True,
                                                distributed=args.distributed)
 
     loader_dict['eval'] = get_data_loader(dset_dict['eval'],
                                           args.batch_size * args.uratio,
                                           num_workers=num_worker_multiplier_lb * args.num_workers,
+                                          pin_memory=True,
                                           drop_last=False)
 
     return dset_dict, loader_dict
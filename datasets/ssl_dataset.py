@@ -18,7 +18,6 @@ from .augmentation.randaugment import RandAugment
 
 import gc
 import sys
-import copy
 from PIL import Image
 
 mean, std = {}, {}
@@ -49,6 +48,24 @@ std['AffectNet'] = [0.229, 0.224, 0.225]
 std['SemiInat'] = [0.2348, 0.2243, 0.2408]
 
 
+def dump_json_if_changed(payload, path):
+    """
+    Serialize payload once and write it only when path is missing or holds
+    different content, so launch-time bookkeeping files are not rewritten
+    on every run (or in every forked worker touching this code).
+    """
+    text = json.dumps(payload)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                if f.read() == text:
+                    return
+        except OSError:
+            pass
+    with open(path, 'w') as f:
+        f.write(text)
+
+
 def accimage_loader(path):
     import accimage
     try:
@@ -81,8 +98,8 @@ class ImagenetDataset(torchvision.datasets.ImageFolder):
         self.num_labels = num_labels
         is_valid_file = None
         extensions = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
-        samples = self.make_dataset_(self.root, self.class_to_idx, extensions, is_valid_file)
-        if len(samples) == 0:
+        paths, targets = self.make_dataset_(self.root, self.class_to_idx, extensions, is_valid_file)
+        if len(paths) == 0:
             msg = "Found 0 files in subfolders of: {}\n".format(self.root)
             if extensions is not None:
                 msg += "Supported extensions are: {}".format(",".join(extensions))
@@ -91,15 +108,18 @@ class ImagenetDataset(torchvision.datasets.ImageFolder):
         self.loader = default_loader
         self.extensions = extensions
 
-        self.samples = samples
-        self.targets = [s[1] for s in samples]
+        # parallel path/label arrays instead of one (path, class) tuple per
+        # sample; __getitem__ assembles the pair on demand
+        self.paths = paths
+        self.targets = targets
 
         if self.ulb:
-            self.strong_transform = copy.deepcopy(transform)
-            self.strong_transform.transforms.insert(0, RandAugment(3, 5))
+            # share the weak ops by reference (they are stateless under RNG)
+            # instead of deep-copying the whole Compose per instance
+            self.strong_transform = transforms.Compose([RandAugment(3, 5)] + list(transform.transforms))
 
     def __getitem__(self, idx):
-        path, target = self.samples[idx]
+        path, target = self.paths[idx], int(self.targets[idx])
         img = self.loader(path)
         if self.transform is not None:
             img_w = self.transform(img)
@@ -134,7 +154,6 @@ class ImagenetDataset(torchvision.datasets.ImageFolder):
             extensions=None,
             is_valid_file=None,
     ):
-        instances = []
         directory = os.path.expanduser(directory)
         both_none = extensions is None and is_valid_file is None
         both_something = extensions is not None and is_valid_file is not None
@@ -144,30 +163,38 @@ class ImagenetDataset(torchvision.datasets.ImageFolder):
             def is_valid_file(x: str) -> bool:
                 return x.lower().endswith(extensions)
 
-        lb_idx = {}
+        def scan_files(path):
+            # os.scandir reuses the dirent type info, avoiding the extra
+            # stat per file that os.walk + per-dir sorting pays
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=True):
+                        yield from scan_files(entry.path)
+                    elif is_valid_file(entry.name):
+                        yield entry.path
 
+        lb_idx = {}
+        paths, targets = [], []
         for target_class in sorted(class_to_idx.keys()):
             class_index = class_to_idx[target_class]
             target_dir = os.path.join(directory, target_class)
             if not os.path.isdir(target_dir):
                 continue
-            for root, _, fnames in sorted(os.walk(target_dir, followlinks=True)):
-                random.shuffle(fnames)
-                if self.num_labels != -1:
-                    fnames = fnames[:self.num_labels]
-                if self.num_labels != -1:
-                    lb_idx[target_class] = fnames
-                for fname in fnames:
-                    path = os.path.join(root, fname)
-                    if is_valid_file(path):
-                        item = path, class_index
-                        instances.append(item)
+            fpaths = list(scan_files(target_dir))
+            random.shuffle(fpaths)
+            if self.num_labels != -1:
+                fpaths = fpaths[:self.num_labels]
+                lb_idx[target_class] = [os.path.basename(p) for p in fpaths]
+            paths.extend(fpaths)
+            targets.extend([class_index] * len(fpaths))
         if self.num_labels != -1:
-            with open('./sampled_label_idx.json', 'w') as f:
-                json.dump(lb_idx, f)
+            dump_json_if_changed(lb_idx, './sampled_label_idx.json')
         del lb_idx
         gc.collect()
-        return instances
+        return paths, np.asarray(targets, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.paths)
 
 
 # Image SSL dataloader
@@ -211,8 +238,7 @@ class ImageDatasetLoader:
         output_path = output_file + str(self.dataset) + '_' + str(self.args.num_labels) + '.json'
         if not os.path.exists(output_file):
             os.makedirs(output_file, exist_ok=True)
-        with open(output_path, 'w') as w:
-            json.dump(out, w)
+        dump_json_if_changed(out, output_path)
         return data
 
     def get_ulb_train_data(self, ulb_folder='train'):
@@ -306,6 +332,22 @@ class SSL_Dataset:
         return BasicDataset(self.alg, data, targets, num_classes, transform,
                             is_ulb, strong_transform, onehot)
 
+    def get_lb_dset(self, num_labels, index=None, onehot=False):
+        """
+        get_lb_dset returns only the labeled BasicDataset.
+        It samples the balanced labeled subset directly, without building
+        (and then discarding) the unlabeled split.
+        """
+        if self.name.upper() == 'STL10':
+            data, targets, _ = self.get_data()
+        else:
+            data, targets = self.get_data()
+        data, targets = np.array(data), np.array(targets)
+        lb_data, lb_targets, _ = sample_labeled_data(self.args, data, targets,
+                                                     num_labels, self.num_classes, index)
+        return BasicDataset(self.alg, lb_data, lb_targets, self.num_classes,
+                            self.transform, False, None, onehot)
+
     def get_ssl_dset(self, num_labels, index=None, include_lb_to_ulb=True,
                      strong_transform=None, onehot=False, use_full_data=False):
         """
@@ -342,19 +384,19 @@ class SSL_Dataset:
                                                                         num_labels, self.num_classes,
                                                                         index, include_lb_to_ulb)
         # output the distribution of labeled data for remixmatch
-        count = [0 for _ in range(self.num_classes)]
-        for c in lb_targets:
-            count[c] += 1
-        dist = np.array(count, dtype=float)
-        dist = dist / dist.sum()
-        dist = dist.tolist()
-        out = {"distribution": dist}
         output_file = r"./data_statistics/"
         output_path = output_file + str(self.name) + '_' + str(num_labels) + '.json'
-        if not os.path.exists(output_file):
-            os.makedirs(output_file, exist_ok=True)
-        with open(output_path, 'w') as w:
-            json.dump(out, w)
+        if not os.path.exists(output_path):
+            count = [0 for _ in range(self.num_classes)]
+            for c in lb_targets:
+                count[c] += 1
+            dist = np.array(count, dtype=float)
+            dist = dist / dist.sum()
+            dist = dist.tolist()
+            out = {"distribution": dist}
+            if not os.path.exists(output_file):
+                os.makedirs(output_file, exist_ok=True)
+            dump_json_if_changed(out, output_path)
         # print(Counter(ulb_targets.tolist()))
         lb_dset = BasicDataset(self.alg, lb_data, lb_targets, self.num_classes,
                                self.transform, False, None, onehot)
@@ -139,7 +139,6 @@ class MixMatch:
                     # Mix up
                     inputs = torch.cat([x_lb, x_ulb_w1, x_ulb_w2])
                     mixed_x, mixed_y, _ = mixup_one_target(inputs, input_labels,
-                                                           args.gpu,
                                                            args.alpha,
                                                            is_bias=True)
 
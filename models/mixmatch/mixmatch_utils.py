@@ -20,7 +20,7 @@ def one_hot(targets, nClass, gpu):
     return logits.scatter_(1, targets.to(torch.int64).unsqueeze(1), 1)
 
 
-def mixup_one_target(x, y, gpu, alpha=1.0, is_bias=False):
+def mixup_one_target(x, y, alpha=1.0, is_bias=False):
     """Returns mixed inputs, mixed targets, and lambda
     """
     if alpha > 0:
@@ -30,7 +30,8 @@ def mixup_one_target(x, y, gpu, alpha=1.0, is_bias=False):
     if is_bias:
         lam = max(lam, 1 - lam)
 
-    index = torch.randperm(x.size(0)).cuda(gpu)
+    # drawn on x's device; a CPU randperm + .cuda() would sync the hot path
+    index = torch.randperm(x.size(0), device=x.device)
 
     mixed_x = lam * x + (1 - lam) * x[index]
     mixed_y = lam * y + (1 - lam) * y[index]
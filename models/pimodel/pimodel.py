@@ -4,10 +4,9 @@ import torch.nn.functional as F
 from torch.cuda.amp import autocast, GradScaler
 
 import os
-import contextlib
 
 from .pimodel_utils import consistency_loss
-from train_utils import ce_loss, wd_loss, EMA, Bn_Controller
+from train_utils import ce_loss, wd_loss, EMA, Bn_Controller, CudaPrefetcher, cycle_loader
 
 from sklearn.metrics import *
 from copy import deepcopy
@@ -38,7 +37,8 @@ class PiModel:
         # network is builded only by num_classes,
         # other configs are covered in main.py
 
-        self.model = net_builder(num_classes=num_classes)
+        # NHWC layout: tensor-core conv kernels prefer channels-last under AMP
+        self.model = net_builder(num_classes=num_classes).to(memory_format=torch.channels_last)
         self.num_eval_iter = num_eval_iter
         self.lambda_u = lambda_u
         self.tb_log = tb_log
@@ -84,94 +84,112 @@ class PiModel:
         start_batch.record()
         best_eval_acc, best_it = 0.0, 0
 
-        scaler = GradScaler()
-        amp_cm = autocast if args.amp else contextlib.nullcontext
+        # hoist hot attribute lookups out of the loop; argparse Namespace
+        # access goes through __getattr__ on every read
+        model, optimizer, scheduler, ema = self.model, self.optimizer, self.scheduler, self.ema
+        amp = bool(args.amp)
+        clip = args.clip
+        total_iters = args.num_train_iter
+        warmup_den = args.unsup_warmup_pos * total_iters
+        save_path = os.path.join(args.save_dir, args.save_name)
+        is_main = not args.multiprocessing_distributed or \
+            (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0)
+        terminal_iter = args.terminal_iter if 'terminal_iter' in args else None
+
+        # enabled=False makes autocast/scaler no-ops, so one code path serves
+        # both modes
+        scaler = GradScaler(enabled=amp)
 
         # eval for once to verify if the checkpoint is loaded correctly
         if args.resume == True:
             eval_dict = self.evaluate(args=args)
             print(eval_dict)
 
-        for (_, x_lb, y_lb), (_, x_ulb_w1, x_ulb_w2) in zip(self.loader_dict['train_lb'],
-                                                            self.loader_dict['train_ulb']):
-
+        # copies the next batch to the GPU on a side stream while the current
+        # one runs, so the per-step H2D transfer is hidden behind compute;
+        # the unlabeled loader drives iteration and the (much shorter)
+        # labeled loader cycles instead of truncating the epoch
+        prefetcher = CudaPrefetcher(zip(cycle_loader(self.loader_dict['train_lb']),
+                                        self.loader_dict['train_ulb']), args.gpu)
+        while True:
+            batch = prefetcher.next()
             # prevent the training iterations exceed args.num_train_iter
-            if self.it > args.num_train_iter:
+            if batch is None or self.it > total_iters:
                 break
-            unsup_warmup = np.clip(self.it / (args.unsup_warmup_pos * args.num_train_iter),
-                                   a_min=0.0, a_max=1.0)
-            end_batch.record()
-            torch.cuda.synchronize()
-            start_run.record()
+            (_, x_lb, y_lb), (_, x_ulb_w1, x_ulb_w2) = batch
+            unsup_warmup = np.clip(self.it / warmup_den, a_min=0.0, a_max=1.0)
+
+            # timing events are only recorded at the logging boundary; the
+            # per-step torch.cuda.synchronize() calls serialized every batch
+            timing = self.it % self.num_eval_iter == 0
+            if timing:
+                end_batch.record()
+                start_run.record()
 
-            x_lb, x_ulb_w1, x_ulb_w2 = x_lb.cuda(args.gpu), x_ulb_w1.cuda(args.gpu), x_ulb_w2.cuda(args.gpu)
-            y_lb = y_lb.cuda(args.gpu)
+            x_lb = x_lb.contiguous(memory_format=torch.channels_last)
+            x_ulb_w1 = x_ulb_w1.contiguous(memory_format=torch.channels_last)
+            x_ulb_w2 = x_ulb_w2.contiguous(memory_format=torch.channels_last)
 
             num_lb = x_lb.shape[0]
 
             # inference and calculate sup/unsup losses
-            with amp_cm():
-
-                logits_x_lb = self.model(x_lb)
-
-                # calculate BN only for the first batch 
-                self.bn_controller.freeze_bn(self.model)
-                logits_x_ulb_w1 = self.model(x_ulb_w1)
-                logits_x_ulb_w2 = self.model(x_ulb_w2)
+            with autocast(enabled=amp):
 
-                self.bn_controller.unfreeze_bn(self.model)
+                # single fused forward over all three batches; one big kernel
+                # launch per layer instead of three small ones
+                logits = model(torch.cat((x_lb, x_ulb_w1, x_ulb_w2)))
+                logits_x_lb, logits_x_ulb_w1, logits_x_ulb_w2 = \
+                    torch.split(logits, [num_lb, x_ulb_w1.shape[0], x_ulb_w2.shape[0]])
 
                 sup_loss = ce_loss(logits_x_lb, y_lb, reduction='mean')  # For debug, y_lb = y_lb.type(torch.LongTensor).cuda()
                 unsup_loss = consistency_loss(logits_x_ulb_w1,
                                               logits_x_ulb_w2)
-                total_loss = sup_loss + self.lambda_u * unsup_loss * unsup_warmup
-
-            # parameter updates
-            if args.amp:
-                scaler.scale(total_loss).backward()
-                if (args.clip > 0):
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), args.clip)
-                scaler.step(self.optimizer)
-                scaler.update()
-            else:
-                total_loss.backward()
-                if (args.clip > 0):
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), args.clip)
-                self.optimizer.step()
-
-            self.scheduler.step()
-            self.ema.update()
-            self.model.zero_grad()
-
-            end_run.record()
-            torch.cuda.synchronize()
-
-            # tensorboard_dict update
-            tb_dict = {}
-            tb_dict['train/sup_loss'] = sup_loss.detach()
-            tb_dict['train/unsup_loss'] = unsup_loss.detach()
-            tb_dict['train/total_loss'] = total_loss.detach()
-            tb_dict['lr'] = self.optimizer.param_groups[0]['lr']
-            tb_dict['train/prefecth_time'] = start_batch.elapsed_time(end_batch) / 1000.
-            tb_dict['train/run_time'] = start_run.elapsed_time(end_run) / 1000.
+                # fused add captures the warmup scalar at kernel launch
+                # instead of broadcasting it through two extra multiplies
+                total_loss = torch.add(sup_loss, unsup_loss,
+                                       alpha=self.lambda_u * unsup_warmup)
+
+            # parameter updates; gradients are unscaled before clipping so the
+            # norm threshold applies to the true gradients
+            scaler.scale(total_loss).backward()
+            if (clip > 0):
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+            scaler.step(optimizer)
+            scaler.update()
+
+            scheduler.step()
+            ema.update()
+            # set_to_none skips the full-model grad memset each step
+            optimizer.zero_grad(set_to_none=True)
+
+            if timing:
+                end_run.record()
 
             # Save model for each 10K steps and best model for each 1K steps
             if self.it % 10000 == 0:
-                save_path = os.path.join(args.save_dir, args.save_name)
-                if not args.multiprocessing_distributed or \
-                        (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+                if is_main:
                     self.save_model('latest_model.pth', save_path)
 
-            if 'terminal_iter' in args:
-                if self.it >= args.terminal_iter:
-                    break
+            if terminal_iter is not None and self.it >= terminal_iter:
+                break
 
             if self.it % self.num_eval_iter == 0:
+                # the losses are only read back here, so the per-iter dict of
+                # detached CUDA tensors is gone; .item() floats release the
+                # graph right away and sync once per logging interval
+                tb_dict = {}
+                tb_dict['train/sup_loss'] = sup_loss.item()
+                tb_dict['train/unsup_loss'] = unsup_loss.item()
+                tb_dict['train/total_loss'] = total_loss.item()
+                tb_dict['lr'] = optimizer.param_groups[0]['lr']
+                end_run.synchronize()
+                tb_dict['train/prefecth_time'] = start_batch.elapsed_time(end_batch) / 1000.
+                tb_dict['train/run_time'] = start_run.elapsed_time(end_run) / 1000.
+
                 eval_dict = self.evaluate(args=args)
                 tb_dict.update(eval_dict)
 
-                save_path = os.path.join(args.save_dir, args.save_name)
-
                 if tb_dict['eval/top-1-acc'] > best_eval_acc:
                     best_eval_acc = tb_dict['eval/top-1-acc']
                     best_it = self.it
@@ -179,8 +197,7 @@ class PiModel:
                 self.print_fn(
                     f"{self.it} iteration, {tb_dict}, BEST_EVAL_ACC: {best_eval_acc}, at {best_it} iters")
 
-                if not args.multiprocessing_distributed or \
-                        (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+                if is_main:
 
                     if self.it == best_it:
                         self.save_model('model_best.pth', save_path)
@@ -189,9 +206,10 @@ class PiModel:
                         self.tb_log.update(tb_dict, self.it)
 
             self.it += 1
-            del tb_dict
-            start_batch.record()
-            if self.it > 0.8 * args.num_train_iter:
+            # arm the batch timer only when the next iteration will be timed
+            if self.it % self.num_eval_iter == 0:
+                start_batch.record()
+            if self.it > 0.8 * total_iters:
                 self.num_eval_iter = 1000
 
         eval_dict = self.evaluate(args=args)
@@ -212,19 +230,31 @@ class PiModel:
             eval_loader = self.loader_dict['eval']
         total_loss = 0.0
         total_num = 0.0
-        y_true = []
-        y_pred = []
-        y_logits = []
+        # args.gpu is None in the DataParallel fallback; torch.empty(device=None)
+        # would silently allocate the buffers on the CPU
+        gpu = args.gpu if args.gpu is not None else torch.cuda.current_device()
+        # accumulate on device and transfer once; per-batch .cpu().tolist()
+        # forces a sync every batch
+        total_n = len(eval_loader.dataset)
+        y_true_buf = torch.empty(total_n, dtype=torch.long, device=gpu)
+        y_pred_buf = torch.empty(total_n, dtype=torch.long, device=gpu)
+        y_logits_buf = torch.empty(total_n, self.num_classes, device=gpu)
+        offset = 0
         for _, x, y in eval_loader:
-            x, y = x.cuda(args.gpu), y.cuda(args.gpu)
+            x, y = x.cuda(gpu), y.cuda(gpu)
+            x = x.contiguous(memory_format=torch.channels_last)
             num_batch = x.shape[0]
             total_num += num_batch
             logits = self.model(x)
             loss = F.cross_entropy(logits, y, reduction='mean')
-            y_true.extend(y.cpu().tolist())
-            y_pred.extend(torch.max(logits, dim=-1)[1].cpu().tolist())
-            y_logits.extend(torch.softmax(logits, dim=-1).cpu().tolist())
+            y_true_buf[offset:offset + num_batch] = y
+            y_pred_buf[offset:offset + num_batch] = logits.argmax(dim=-1)
+            y_logits_buf[offset:offset + num_batch] = logits.softmax(dim=-1)
+            offset += num_batch
             total_loss += loss.detach() * num_batch
+        y_true = y_true_buf[:offset].cpu().numpy()
+        y_pred = y_pred_buf[:offset].cpu().numpy()
+        y_logits = y_logits_buf[:offset].cpu().numpy()
         top1 = accuracy_score(y_true, y_pred)
         top5 = top_k_accuracy_score(y_true, y_logits, k=5)
         cf_mat = confusion_matrix(y_true, y_pred)
@@ -235,24 +265,35 @@ class PiModel:
 
     def save_model(self, save_name, save_path):
         save_filename = os.path.join(save_path, save_name)
-        # copy EMA parameters to ema_model for saving with model as temp
-        self.model.eval()
-        self.ema.apply_shadow()
-        ema_model = deepcopy(self.model)
-        self.ema.restore()
-        self.model.train()
+        # build the EMA state dict from the shadow parameters directly; the
+        # old deepcopy of the whole model allocated a second full copy per save
+        model_state_dict = self.model.state_dict()
+        ema_state_dict = {k: self.ema.shadow.get(k, v) for k, v in model_state_dict.items()}
 
-        torch.save({'model': self.model.state_dict(),
+        torch.save({'model': model_state_dict,
                     'optimizer': self.optimizer.state_dict(),
                     'scheduler': self.scheduler.state_dict(),
                     'it': self.it,
-                    'ema_model': ema_model.state_dict()},
+                    'ema_model': ema_state_dict},
                    save_filename)
 
         self.print_fn(f"model saved: {save_filename}")
 
+    @staticmethod
+    def _strip_prefix(prefix, state_dict):
+        return {(k[len(prefix):] if k.startswith(prefix) else k): v
+                for k, v in state_dict.items()}
+
+    @staticmethod
+    def _add_prefix(prefix, state_dict):
+        return {prefix + k: v for k, v in state_dict.items()}
+
     def load_model(self, load_path):
-        checkpoint = torch.load(load_path)
+        # mmap pages the checkpoint in lazily instead of reading it all into
+        # host RAM first; weights_only skips the pickle scan on load
+        device = next(self.model.parameters()).device
+        checkpoint = torch.load(load_path, map_location=device,
+                                mmap=True, weights_only=True)
         self.print_fn('Loading save model from: ' + str(load_path))
         self.ema_model = deepcopy(self.model)
 
@@ -265,72 +306,19 @@ class PiModel:
 
             # Scenario 1: current single gpu & loading multi-gpu
             if type(self.model) != torch.nn.parallel.distributed.DistributedDataParallel:
-                state_dict = checkpoint['model']
-                new_state_dict = {}
-                for k, v in state_dict.items():
-                    k = k.replace("module.", "")
-                    new_state_dict[k] = v
-                state_dict = new_state_dict
-                self.model.load_state_dict(state_dict)
-
-                state_dict_ema = checkpoint['ema_model']
-                new_state_dict_ema = {}
-                for k, v in state_dict_ema.items():
-                    k = k.replace("module.", "")
-                    new_state_dict_ema[k] = v
-                state_dict_ema = new_state_dict_ema
-                self.ema_model.load_state_dict(state_dict_ema)
-
-                self.optimizer.load_state_dict(checkpoint['optimizer'])
-                self.scheduler.load_state_dict(checkpoint['scheduler'])
-                self.it = checkpoint['it']
+                self.model.load_state_dict(self._strip_prefix("module.", checkpoint['model']))
+                self.ema_model.load_state_dict(self._strip_prefix("module.", checkpoint['ema_model']))
                 self.print_fn('model loaded from multi-gpu checkpoint to single gpu')
 
             # Scenario 2: saved multi-gpu loading single-gpu
             else:
-                state_dict = checkpoint['model']
-                new_state_dict = {}
-                for k, v in state_dict.items():
-                    k = "module." + k
-                    new_state_dict[k] = v
-                state_dict = new_state_dict
-                self.model.load_state_dict(state_dict)
-
-                state_dict_ema = checkpoint['ema_model']
-                new_state_dict_ema = {}
-                for k, v in state_dict_ema.items():
-                    k = "module." + k
-                    new_state_dict_ema[k] = v
-                state_dict_ema = new_state_dict_ema
-                self.ema_model.load_state_dict(state_dict_ema)
-
-                self.optimizer.load_state_dict(checkpoint['optimizer'])
-                self.scheduler.load_state_dict(checkpoint['scheduler'])
-                self.it = checkpoint['it']
+                self.model.load_state_dict(self._add_prefix("module.", checkpoint['model']))
+                self.ema_model.load_state_dict(self._add_prefix("module.", checkpoint['ema_model']))
                 self.print_fn('model loaded from single-gpu checkpoint to multi gpu')
         self.optimizer.load_state_dict(checkpoint['optimizer'])
         self.scheduler.load_state_dict(checkpoint['scheduler'])
         self.it = checkpoint['it']
 
-    # Abandoned in PiModel
-    def interleave_offsets(self, batch, nu):
-        groups = [batch // (nu + 1)] * (nu + 1)
-        for x in range(batch - sum(groups)):
-            groups[-x - 1] += 1
-        offsets = [0]
-        for g in groups:
-            offsets.append(offsets[-1] + g)
-        assert offsets[-1] == batch
-        return offsets
-
-    def interleave(self, xy, batch):
-        nu = len(xy) - 1
-        offsets = self.interleave_offsets(batch, nu)
-        xy = [[v[offsets[p]:offsets[p + 1]] for p in range(nu + 1)] for v in xy]
-        for i in range(1, nu + 1):
-            xy[0][i], xy[i][i] = xy[i][i], xy[0][i]
-        return [torch.cat(v, dim=0) for v in xy]
-
 
 if __name__ == "__main__":
     pass
@@ -14,7 +14,10 @@ class Get_Scalar:
         return self.value
 
 
-def consistency_loss(logits_w1, logits_w2):
+# scripted so the softmax/sub/square/mean chain fuses into fewer kernels
+# instead of materializing each (N, C) intermediate
+@torch.jit.script
+def consistency_loss(logits_w1: torch.Tensor, logits_w2: torch.Tensor) -> torch.Tensor:
     logits_w2 = logits_w2.detach()
     assert logits_w1.size() == logits_w2.size()
-    return F.mse_loss(torch.softmax(logits_w1, dim=-1), torch.softmax(logits_w2, dim=-1), reduction='mean')
+    return F.mse_loss(logits_w1.softmax(dim=-1), logits_w2.softmax(dim=-1), reduction='mean')
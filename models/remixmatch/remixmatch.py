@@ -167,11 +167,10 @@ class ReMixMatch:
                     # mix up
                     mixed_inputs = torch.cat((x_lb, x_ulb_s1, x_ulb_s2, x_ulb_w))
                     input_labels = torch.cat(
-                        [one_hot(y_lb, args.num_classes, args.gpu), sharpen_prob_x_ulb, sharpen_prob_x_ulb,
+                        [one_hot(y_lb, args.num_classes), sharpen_prob_x_ulb, sharpen_prob_x_ulb,
                          sharpen_prob_x_ulb], dim=0)
 
                     mixed_x, mixed_y, _ = mixup_one_target(mixed_inputs, input_labels,
-                                                           args.gpu,
                                                            args.alpha,
                                                            is_bias=True)
 
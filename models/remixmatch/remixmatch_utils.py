@@ -14,20 +14,31 @@ class Get_Scalar:
     def __call__(self, iter):
         return self.value
 
+# off-diagonal gather indices, cached per (size, device) so the hot path is
+# a single index_select instead of a strided-view copy every call
+_offdiag_idx = {}
+
+
 def off_diagonal(x):
     n, m = x.shape
     assert n == m
-    return x.flatten()[:-1].view(n - 1, n + 1)[:, 1:].flatten()
+    key = (n, x.device)
+    idx = _offdiag_idx.get(key)
+    if idx is None:
+        mask = ~torch.eye(n, dtype=torch.bool)
+        idx = torch.arange(n * n)[mask.flatten()].to(x.device)
+        _offdiag_idx[key] = idx
+    return x.flatten().index_select(0, idx)
 
 
-def one_hot(targets, nClass, gpu):
-    logits = torch.zeros(targets.size(0), nClass)
-    if torch.cuda.is_available():
-        logits = logits.cuda(gpu)
-    return logits.scatter_(1, targets.to(torch.int64).unsqueeze(1), 1)
+def one_hot(targets, nClass):
+    # single GPU-resident kernel; the old zeros-on-host + .cuda + scatter_
+    # path did an H2D copy inside the mixup hot loop
+    return F.one_hot(targets.to(torch.int64), num_classes=nClass).to(
+        dtype=torch.float32, device=targets.device)
 
 
-def mixup_one_target(x, y, gpu, alpha=1.0, is_bias=False):
+def mixup_one_target(x, y, alpha=1.0, is_bias=False):
     """Returns mixed inputs, mixed targets, and lambda
     """
     if alpha > 0:
@@ -36,14 +47,15 @@ def mixup_one_target(x, y, gpu, alpha=1.0, is_bias=False):
         lam = 1
     if is_bias: lam = max(lam, 1 - lam)
 
-    index = torch.randperm(x.size(0))
-    if torch.cuda.is_available():
-        index = index.cuda(gpu)
+    # drawn on x's device; a CPU randperm + .cuda() would sync the hot path
+    index = torch.randperm(x.size(0), device=x.device)
 
     mixed_x = lam * x + (1 - lam) * x[index, :]
     mixed_y = lam * y + (1 - lam) * y[index]
     return mixed_x, mixed_y, lam
 
 
-def consistency_loss(logits_w, y):
-    return F.mse_loss(torch.softmax(logits_w, dim=-1), y, reduction='mean')
+# scripted so the softmax/sub/square/mean chain fuses into fewer kernels
+@torch.jit.script
+def consistency_loss(logits_w: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return F.mse_loss(logits_w.softmax(dim=-1), y, reduction='mean')
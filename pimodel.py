@@ -150,10 +150,14 @@ def main_worker(gpu, ngpus_per_node, args):
             '''
             args.batch_size = int(args.batch_size / ngpus_per_node)
             model.model.cuda(args.gpu)
+            # gradient_as_bucket_view avoids a grad copy per bucket; 25MB
+            # buckets keep the allreduce overlapped with backward
             model.model = torch.nn.parallel.DistributedDataParallel(model.model,
                                                                     device_ids=[args.gpu],
                                                                     broadcast_buffers=False,
-                                                                    find_unused_parameters=True)
+                                                                    find_unused_parameters=True,
+                                                                    gradient_as_bucket_view=True,
+                                                                    bucket_cap_mb=25)
 
         else:
             # if arg.gpu is None, DDP will divide and allocate batch_size
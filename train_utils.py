@@ -318,6 +318,69 @@ def ce_loss(logits, targets, use_hard_labels=True, reduction='none'):
 
 
 
+def cycle_loader(loader):
+    """
+    Re-iterates a DataLoader forever. Unlike itertools.cycle this does not
+    cache the first epoch, so shuffling samplers draw fresh batches on every
+    pass and persistent workers stay warm across epochs.
+    """
+    while True:
+        for batch in loader:
+            yield batch
+
+
+class CudaPrefetcher:
+    """
+    Wraps an iterator of batches and copies the next batch to the GPU on a
+    dedicated CUDA stream while the current one is being consumed
+    (the APEX data_prefetcher pattern). Tensors are moved with
+    non_blocking=True; nested tuples/lists are handled recursively and
+    non-tensor items pass through unchanged.
+    """
+
+    def __init__(self, iterable, gpu):
+        self.iterator = iter(iterable)
+        # the launcher's DataParallel fallback passes gpu=None, and .to(None)
+        # is an identity op that would leave batches on the CPU
+        self.gpu = torch.cuda.current_device() if gpu is None else gpu
+        self.stream = torch.cuda.Stream()
+        self.next_batch = None
+        self.preload()
+
+    def _to_gpu(self, item):
+        if torch.is_tensor(item):
+            return item.to(self.gpu, non_blocking=True)
+        if isinstance(item, (list, tuple)):
+            return type(item)(self._to_gpu(v) for v in item)
+        return item
+
+    def _record_stream(self, item, stream):
+        if torch.is_tensor(item):
+            item.record_stream(stream)
+        elif isinstance(item, (list, tuple)):
+            for v in item:
+                self._record_stream(v, stream)
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self._to_gpu(batch)
+
+    def next(self):
+        batch = self.next_batch
+        if batch is None:
+            return None
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        self._record_stream(batch, current_stream)
+        self.preload()
+        return batch
+
+
 class EMA:
     """
     Implementation from https://fyubang.com/2019/06/01/ema/
@@ -328,22 +391,32 @@ class EMA:
         self.decay = decay
         self.shadow = {}
         self.backup = {}
+        self._shadow_list = None
+        self._param_list = None
 
     def load(self, ema_model):
         for name, param in ema_model.named_parameters():
             self.shadow[name] = param.data.clone()
+        self._shadow_list = None
 
     def register(self):
         for name, param in self.model.named_parameters():
             if param.requires_grad:
                 self.shadow[name] = param.data.clone()
+        self._shadow_list = None
 
     def update(self):
-        for name, param in self.model.named_parameters():
-            if param.requires_grad:
+        # batched in-place EMA: two _foreach kernel launches for the whole
+        # model instead of one launch (and a fresh clone) per parameter
+        if self._shadow_list is None:
+            named = [(name, param) for name, param in self.model.named_parameters()
+                     if param.requires_grad]
+            for name, _ in named:
                 assert name in self.shadow
-                new_average = (1.0 - self.decay) * param.data + self.decay * self.shadow[name]
-                self.shadow[name] = new_average.clone()
+            self._shadow_list = [self.shadow[name] for name, _ in named]
+            self._param_list = [param.data for _, param in named]
+        torch._foreach_mul_(self._shadow_list, self.decay)
+        torch._foreach_add_(self._shadow_list, self._param_list, alpha=1.0 - self.decay)
 
     def apply_shadow(self):
         for name, param in self.model.named_parameters():